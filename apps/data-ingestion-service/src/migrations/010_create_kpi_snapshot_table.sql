@@ -0,0 +1,110 @@
+-- FILE: apps/data-ingestion-service/src/migrations/010_create_kpi_snapshot_table.sql
+-- This table is a precomputed, per-building KPI snapshot used to answer the most common
+-- copilot questions (building count, best performers, latest efficiency, asset status)
+-- without aggregating over the whole daily_metrics table on every request.
+-- It holds one row per building and is kept up to date incrementally by triggers,
+-- so reading it costs the same no matter how much history daily_metrics accumulates.
+
+CREATE TABLE IF NOT EXISTS building_kpi_snapshot (
+    building_uuid TEXT PRIMARY KEY REFERENCES buildings(uuid) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    asset_status TEXT,
+    asset_active BOOLEAN,
+
+    -- Running totals so the average efficiency is a single division: efficiency_sum / efficiency_count.
+    efficiency_sum NUMERIC NOT NULL DEFAULT 0,
+    efficiency_count BIGINT NOT NULL DEFAULT 0,
+
+    -- The most recent daily_metrics row for this building.
+    latest_time_period DATE,
+    latest_efficiency NUMERIC,
+
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- One-time backfill. Migrations run on every startup, so only do the full aggregation
+-- when the snapshot is still empty; after that the triggers below keep it current.
+INSERT INTO building_kpi_snapshot (
+    building_uuid, name, asset_status, asset_active,
+    efficiency_sum, efficiency_count, latest_time_period, latest_efficiency
+)
+SELECT
+    b.uuid, b.name, b.asset_status, b.asset_active,
+    COALESCE(SUM(dm.efficiency), 0), COUNT(dm.efficiency),
+    latest.time_period, latest.efficiency
+FROM buildings b
+LEFT JOIN daily_metrics dm ON dm.building_uuid = b.uuid
+LEFT JOIN LATERAL (
+    SELECT time_period, efficiency FROM daily_metrics
+    WHERE building_uuid = b.uuid
+    ORDER BY time_period DESC LIMIT 1
+) latest ON TRUE
+WHERE NOT EXISTS (SELECT 1 FROM building_kpi_snapshot)
+GROUP BY b.uuid, b.name, b.asset_status, b.asset_active, latest.time_period, latest.efficiency;
+
+-- Keep the descriptive columns in sync with the buildings master table.
+CREATE OR REPLACE FUNCTION sync_building_kpi_snapshot()
+RETURNS TRIGGER AS $$
+BEGIN
+  INSERT INTO building_kpi_snapshot (building_uuid, name, asset_status, asset_active, updated_at)
+  VALUES (NEW.uuid, NEW.name, NEW.asset_status, NEW.asset_active, CURRENT_TIMESTAMP)
+  ON CONFLICT (building_uuid) DO UPDATE SET
+    name = EXCLUDED.name,
+    asset_status = EXCLUDED.asset_status,
+    asset_active = EXCLUDED.asset_active,
+    updated_at = CURRENT_TIMESTAMP;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS buildings_kpi_snapshot_trigger ON buildings;
+
+CREATE TRIGGER buildings_kpi_snapshot_trigger
+AFTER INSERT OR UPDATE ON buildings
+FOR EACH ROW EXECUTE FUNCTION sync_building_kpi_snapshot();
+
+-- Apply each daily_metrics change to the running totals. Updates (from the ingestion
+-- upserts) first remove the old row's contribution and then add the new one.
+CREATE OR REPLACE FUNCTION apply_daily_metrics_to_kpi_snapshot()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.efficiency IS NOT NULL THEN
+    UPDATE building_kpi_snapshot SET
+      efficiency_sum = efficiency_sum - OLD.efficiency,
+      efficiency_count = efficiency_count - 1,
+      updated_at = CURRENT_TIMESTAMP
+    WHERE building_uuid = OLD.building_uuid;
+  END IF;
+
+  IF TG_OP = 'DELETE' THEN
+    -- If the latest row was removed, look up the new latest one via the (building_uuid, time_period) index.
+    UPDATE building_kpi_snapshot SET
+      (latest_time_period, latest_efficiency) = (
+        SELECT time_period, efficiency FROM daily_metrics
+        WHERE building_uuid = OLD.building_uuid
+        ORDER BY time_period DESC LIMIT 1
+      ),
+      updated_at = CURRENT_TIMESTAMP
+    WHERE building_uuid = OLD.building_uuid AND latest_time_period = OLD.time_period;
+    RETURN OLD;
+  END IF;
+
+  UPDATE building_kpi_snapshot SET
+    efficiency_sum = efficiency_sum + COALESCE(NEW.efficiency, 0),
+    efficiency_count = efficiency_count + CASE WHEN NEW.efficiency IS NULL THEN 0 ELSE 1 END,
+    latest_efficiency = CASE
+      WHEN latest_time_period IS NULL OR NEW.time_period >= latest_time_period THEN NEW.efficiency
+      ELSE latest_efficiency
+    END,
+    latest_time_period = GREATEST(latest_time_period, NEW.time_period),
+    updated_at = CURRENT_TIMESTAMP
+  WHERE building_uuid = NEW.building_uuid;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS daily_metrics_kpi_snapshot_trigger ON daily_metrics;
+
+CREATE TRIGGER daily_metrics_kpi_snapshot_trigger
+AFTER INSERT OR UPDATE OR DELETE ON daily_metrics
+FOR EACH ROW EXECUTE FUNCTION apply_daily_metrics_to_kpi_snapshot();
@@ -1,6 +1,8 @@
 # File: apps/db-tools/main.py
 
+import json
 import os
+from datetime import datetime
 from fastapi import FastAPI
 from fastmcp.server import FastMCP
 import asyncpg
@@ -11,6 +13,19 @@ load_dotenv()
 mcp = FastMCP(name="DatabaseToolsServer")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Numeric columns of `dashboard_data` that may be downsampled. Metric names are interpolated
+# into SQL as identifiers, so only names from this set are ever accepted.
+DASHBOARD_METRIC_COLUMNS = frozenset("""
+    most_wanted rank_overall rank_network rank_customer overflow_abs overflow_rel overflow_spec
+    energy_abs volume_abs volume_spec volume_trend flow_dim demand_sig demand_flex demand_k
+    demand_max demand_dim dt_abs dt_vw dt_ideal dt_trend dt_srd rt_abs rt_vw rt_trend rt_srd
+    rt_flex ntu ntu_srd lmtd efficiency efficiency_srd supply_abs supply_flex fault_prim_loss
+    fault_smirch fault_heat_sys fault_valve fault_transfer primloss_rank smirch_rank heatsys_rank
+    valve_rank transfer_rank x_sum y_sum vector_len supply_pos dt_pos rt_pos ntu_pos eff_pos
+""".split())
+MAX_SERIES_METRICS = 8
+MAX_SERIES_POINTS = 2000
+
 @mcp.tool()
 async def query_database(sql_query: str) -> str:
     """
@@ -98,6 +113,8 @@ The most detailed source of time-series data for deep analysis and dashboarding.
 -   `overflow_abs` (NUMERIC): Absolute overflow value.
 -   `energy_abs` (NUMERIC): Absolute energy value.
 -   `volume_abs` (NUMERIC): Absolute volume value.
+
+To look at trends in `dashboard_data` over a time range, use `get_downsampled_series` instead of selecting raw rows here.
 ---
 """
     if any(keyword in sql_query.upper() for keyword in ["INSERT", "UPDATE", "DELETE", "DROP", "CREATE", "ALTER"]):
@@ -110,6 +127,158 @@ The most detailed source of time-series data for deep analysis and dashboarding.
     except Exception as e:
         return f"Error executing query: {e}"
 
+@mcp.tool()
+async def get_kpi_snapshot() -> str:
+    """
+Returns the precomputed KPI snapshot for every building as a JSON list. Use this tool instead of `query_database` for building counts, best/worst performers by average efficiency, the latest efficiency of a building, and asset status.
+
+The snapshot is maintained incrementally by the database as new metrics are ingested, so it is always current and answers instantly regardless of how much history exists.
+
+Each entry contains:
+-   `building_uuid` (TEXT): The unique identifier for the building.
+-   `name` (TEXT): The human-readable name of the building.
+-   `asset_status` (TEXT): The operational status code.
+-   `asset_active` (BOOLEAN): Flag indicating if the asset is currently active.
+-   `avg_efficiency` (NUMBER or null): Average daily efficiency over all recorded days.
+-   `efficiency_days` (INTEGER): Number of days with a recorded efficiency.
+-   `latest_time_period` (DATE or null): The most recent day with daily metrics.
+-   `latest_efficiency` (NUMBER or null): The efficiency recorded on that day.
+"""
+    try:
+        conn = await asyncpg.connect(DATABASE_URL)
+        rows = await conn.fetch("""
+            SELECT building_uuid, name, asset_status, asset_active,
+                   efficiency_sum / NULLIF(efficiency_count, 0) AS avg_efficiency,
+                   efficiency_count AS efficiency_days,
+                   latest_time_period, latest_efficiency
+            FROM building_kpi_snapshot
+            ORDER BY name;
+        """)
+        await conn.close()
+        snapshot = [
+            {
+                **dict(row),
+                "avg_efficiency": float(row["avg_efficiency"]) if row["avg_efficiency"] is not None else None,
+                "latest_efficiency": float(row["latest_efficiency"]) if row["latest_efficiency"] is not None else None,
+                "latest_time_period": row["latest_time_period"].isoformat() if row["latest_time_period"] else None,
+            }
+            for row in rows
+        ]
+        return json.dumps(snapshot)
+    except Exception as e:
+        return f"Error reading KPI snapshot: {e}"
+
+def _escape_like(value: str) -> str:
+    """Escape LIKE wildcards so a building name only matches itself as a substring."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _round(value):
+    return round(float(value), 4) if value is not None else None
+
+@mcp.tool()
+async def get_downsampled_series(
+    building_names: list[str],
+    metrics: list[str],
+    start_time: str | None = None,
+    end_time: str | None = None,
+    target_points: int = 300,
+) -> str:
+    """
+Use this tool for trends and time-series questions over the granular `dashboard_data` table (e.g., "How has efficiency developed in Delbancogatan 3 over the last year?"). It returns a compact, downsampled series computed in the database instead of raw rows, so long time horizons fit in a single response.
+
+**Arguments:**
+-   `building_names`: List of building names (e.g., ['Delbancogatan 3']). Partial, case-insensitive matches are accepted.
+-   `metrics`: List of up to 8 numeric `dashboard_data` columns (e.g., ['efficiency', 'dt_abs', 'rt_abs']).
+-   `start_time` / `end_time`: Optional ISO timestamps (e.g., '2025-01-01'). Default to the full available range.
+-   `target_points`: Approximate number of points per series (default 300, max 2000).
+
+The range is split into equal time buckets and each bucket reports the `min`, `mean` and `max` of every metric, which preserves peaks and dips that a plain average would hide. Each building also gets `summary` statistics (`count`, `min`, `mean`, `max`, `stddev`) over the whole range.
+
+Returns JSON: `{"bucket_seconds": ..., "buildings": {name: {"t": [...], "n": [...], "<metric>": {"min": [...], "mean": [...], "max": [...]}, "summary": {...}}}}`.
+"""
+    unknown = [m for m in metrics if m not in DASHBOARD_METRIC_COLUMNS]
+    if not metrics or unknown:
+        return f"Error: Unknown or missing metrics {unknown}. Choose numeric columns of `dashboard_data`."
+    if len(metrics) > MAX_SERIES_METRICS:
+        return f"Error: At most {MAX_SERIES_METRICS} metrics can be requested at once."
+    if not building_names:
+        return "Error: At least one building name is required."
+    try:
+        start = datetime.fromisoformat(start_time.replace("Z", "+00:00")) if start_time else None
+        end = datetime.fromisoformat(end_time.replace("Z", "+00:00")) if end_time else None
+    except ValueError as e:
+        return f"Error: Invalid time range: {e}"
+    target_points = max(1, min(int(target_points), MAX_SERIES_POINTS))
+
+    aggregates = ", ".join(f"MIN({m}) AS {m}_min, AVG({m}) AS {m}_mean, MAX({m}) AS {m}_max" for m in metrics)
+    bucket_stddevs = ", ".join(f"NULL::numeric AS {m}_stddev" for m in metrics)
+    summary_stddevs = ", ".join(f"STDDEV_POP({m}) AS {m}_stddev" for m in metrics)
+    # One pass over the (uuid, time_period) index: the bounds CTE picks the bucket width, and
+    # `bucketed` (referenced twice, so materialized once) feeds both the per-bucket rows and a
+    # per-building summary row. The standard deviation is only computed for the summary.
+    sql_query = f"""
+        WITH selected AS (
+            SELECT uuid, name FROM buildings WHERE name ILIKE ANY($1::text[])
+        ),
+        bounds AS (
+            SELECT COALESCE($2::timestamptz, MIN(d.time_period)) AS lo,
+                   COALESCE($3::timestamptz, MAX(d.time_period)) AS hi
+            FROM dashboard_data d JOIN selected s ON d.uuid = s.uuid
+        ),
+        params AS (
+            SELECT lo, hi, GREATEST(EXTRACT(EPOCH FROM hi - lo)::float8 / $4::float8, 1) AS bucket_seconds FROM bounds
+        ),
+        bucketed AS (
+            SELECT s.name, p.bucket_seconds,
+                   date_bin(make_interval(secs => p.bucket_seconds), d.time_period, p.lo) AS bucket,
+                   {", ".join(f"d.{m}" for m in metrics)}
+            FROM dashboard_data d
+            JOIN selected s ON d.uuid = s.uuid
+            CROSS JOIN params p
+            WHERE d.time_period BETWEEN p.lo AND p.hi
+        )
+        SELECT name, bucket, 0 AS is_summary, MAX(bucket_seconds) AS bucket_seconds,
+               COUNT(*) AS n, {aggregates}, {bucket_stddevs}
+        FROM bucketed
+        GROUP BY name, bucket
+        UNION ALL
+        SELECT name, NULL::timestamptz, 1, MAX(bucket_seconds), COUNT(*), {aggregates}, {summary_stddevs}
+        FROM bucketed
+        GROUP BY name
+        ORDER BY name, is_summary, bucket;
+    """
+    try:
+        conn = await asyncpg.connect(DATABASE_URL)
+        rows = await conn.fetch(
+            sql_query, [f"%{_escape_like(name)}%" for name in building_names], start, end, float(target_points)
+        )
+        await conn.close()
+    except Exception as e:
+        return f"Error executing query: {e}"
+
+    if not rows:
+        return "No data found for the requested buildings and time range."
+
+    buildings = {}
+    for row in rows:
+        series = buildings.setdefault(row["name"], {"t": [], "n": [], **{m: {"min": [], "mean": [], "max": []} for m in metrics}})
+        if row["is_summary"]:
+            series["summary"] = {
+                "count": row["n"],
+                **{
+                    m: {stat: _round(row[f"{m}_{stat}"]) for stat in ("min", "mean", "max", "stddev")}
+                    for m in metrics
+                },
+            }
+            continue
+        series["t"].append(row["bucket"].isoformat())
+        series["n"].append(row["n"])
+        for m in metrics:
+            for stat in ("min", "mean", "max"):
+                series[m][stat].append(_round(row[f"{m}_{stat}"]))
+
+    return json.dumps({"bucket_seconds": _round(rows[0]["bucket_seconds"]), "buildings": buildings})
+
 mcp_app = mcp.http_app()
 app = FastAPI(title="Database Tools Host", lifespan=mcp_app.lifespan)
 app.mount("/", mcp_app)
\ No newline at end of file
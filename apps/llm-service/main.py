@@ -1,12 +1,16 @@
+import asyncio
 import functools
 import json
 import os
 import re
+import time
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from typing import Any, List, Type, Literal
 
 from dotenv import load_dotenv
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastmcp.client import Client
 # FIXED: Use the correct import for modern LlamaIndex
@@ -27,6 +31,28 @@ TOOL_SERVERS = {
     "pdf_tools": "http://pdf-tools:8003/mcp/",
     "rag_tools": "http://rag-service:8004/mcp/",
 }
+# How often the in-memory KPI snapshot is re-read from db-tools. The snapshot table itself
+# is maintained incrementally by the database whenever ingestion writes new metrics.
+KPI_SNAPSHOT_REFRESH_SECONDS = int(os.getenv("KPI_SNAPSHOT_REFRESH_SECONDS", "60"))
+
+# --- Resilience Configuration ---
+# Total time budget for one /chat request; every downstream call gets what is left of it.
+CHAT_DEADLINE_SECONDS = float(os.getenv("CHAT_DEADLINE_SECONDS", "30"))
+# Upper bound for a single call even when more of the request deadline remains.
+TOOL_TIMEOUT_SECONDS = float(os.getenv("TOOL_TIMEOUT_SECONDS", "15"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "20"))
+# Per-downstream (max concurrent calls, max calls waiting for a slot).
+DOWNSTREAM_LIMITS = {
+    "db_tools": (10, 50),
+    "pdf_tools": (2, 8),
+    "rag_tools": (4, 16),
+    "gemini": (int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")), int(os.getenv("GEMINI_MAX_QUEUE", "32"))),
+}
+# A circuit opens after this many consecutive failed or slow calls and fails fast
+# for CIRCUIT_OPEN_SECONDS before letting a single probe call through.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_SLOW_CALL_SECONDS = 10.0
+CIRCUIT_OPEN_SECONDS = 30.0
 
 # --- AGENT SYSTEM PROMPT ---
 AGENT_SYSTEM_PROMPT = """
@@ -68,18 +94,126 @@ llm = None
 all_tools = []
 session_chat_engines = {}  # FIXED: Use chat engines instead of agents
 db_tool_callable = None
+kpi_snapshot_callable = None
+kpi_snapshot: List[dict] | None = None  # None until the first successful refresh
+kpi_ranking: List[dict] = []  # kpi_snapshot sorted by avg_efficiency, buildings without metrics last
+
+# --- Resilience ---
+class DownstreamUnavailable(Exception):
+    """Raised instead of calling a downstream whose circuit is open or whose deadline has passed."""
+
+class DownstreamOverloaded(Exception):
+    """Raised when a downstream's queue is full and the call is shed."""
+
+# Monotonic deadline of the /chat request being served, if any.
+request_deadline: ContextVar[float | None] = ContextVar("request_deadline", default=None)
+
+def remaining_time(cap: float) -> float:
+    """Seconds left for a downstream call: the request deadline, bounded by cap."""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return cap
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DownstreamUnavailable("request deadline exceeded")
+    return min(cap, remaining)
+
+class DownstreamGuard:
+    """Concurrency limit with a bounded queue and a circuit breaker for one downstream."""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_pending = max_concurrency + max_queue
+        self.pending = 0
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self.probe_in_flight = False
+
+    def _admit(self) -> bool:
+        """Raise if the call must not proceed; returns True if it is the half-open probe."""
+        if self.opened_at is not None:
+            if time.monotonic() - self.opened_at < CIRCUIT_OPEN_SECONDS or self.probe_in_flight:
+                raise DownstreamUnavailable(f"circuit open for {self.name}")
+        if self.pending >= self.max_pending:
+            raise DownstreamOverloaded(f"{self.name} is overloaded")
+        if self.opened_at is not None:
+            # Half-open: let exactly one probe through to test recovery.
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def _record(self, ok: bool) -> None:
+        self.probe_in_flight = False
+        if ok:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            return
+        self.consecutive_failures += 1
+        if self.opened_at is not None or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            if self.opened_at is None:
+                print(f"Circuit opened for {self.name} after {self.consecutive_failures} failures.")
+            self.opened_at = time.monotonic()
+
+    async def _run(self, fn, cap: float):
+        """Call fn() with a slot already held; only its own outcome feeds the breaker."""
+        timeout = remaining_time(cap)
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(fn(), timeout)
+        except asyncio.TimeoutError:
+            # Running out of the request deadline says nothing about the downstream.
+            if timeout >= cap:
+                self._record(ok=False)
+            raise
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._record(ok=False)
+            raise
+        self._record(ok=time.monotonic() - started < CIRCUIT_SLOW_CALL_SECONDS)
+        return result
+
+    async def call(self, fn, cap: float):
+        """Run fn() within the remaining request deadline (at most cap seconds)."""
+        remaining_time(cap)
+        is_probe = self._admit()
+        self.pending += 1
+        try:
+            # Time spent queued for a slot counts against the request deadline only.
+            await asyncio.wait_for(self.semaphore.acquire(), remaining_time(cap))
+            try:
+                return await self._run(fn, cap)
+            finally:
+                self.semaphore.release()
+        finally:
+            self.pending -= 1
+            if is_probe:
+                # The probe may end without a verdict (shed, deadline, cancellation); allow another.
+                self.probe_in_flight = False
+
+downstream_guards = {name: DownstreamGuard(name, *limits) for name, limits in DOWNSTREAM_LIMITS.items()}
+SERVER_NAMES = {server_url: server_name for server_name, server_url in TOOL_SERVERS.items()}
 
 # --- Tool Functions ---
 async def call_remote_tool(server_url: str, tool_name: str, **kwargs) -> str:
-    try:
+    async def invoke() -> str:
         async with Client(server_url) as client:
             result = await client.call_tool(tool_name, kwargs)
             return str(result.data)
+
+    try:
+        return await downstream_guards[SERVER_NAMES[server_url]].call(invoke, TOOL_TIMEOUT_SECONDS)
+    except DownstreamOverloaded:
+        # Shed the whole request; /chat turns this into an overload response.
+        raise
+    except asyncio.TimeoutError:
+        return f"Error calling MCP tool '{tool_name}': timed out"
     except Exception as e:
         return f"Error calling MCP tool '{tool_name}': {e}"
 
 async def discover_tools() -> List[FunctionTool]:
-    global db_tool_callable
+    global db_tool_callable, kpi_snapshot_callable
     print("Starting tool discovery...")
     discovered_tools = []
     for server_name, server_url in TOOL_SERVERS.items():
@@ -97,6 +231,8 @@ async def discover_tools() -> List[FunctionTool]:
                     )
                     if tool_spec.name == 'query_database':
                         db_tool_callable = tool_callable
+                    elif tool_spec.name == 'get_kpi_snapshot':
+                        kpi_snapshot_callable = tool_callable
                     llama_tool = FunctionTool.from_defaults(
                         fn=tool_callable, name=tool_spec.name,
                         description=tool_spec.description, fn_schema=dynamic_model
@@ -107,6 +243,44 @@ async def discover_tools() -> List[FunctionTool]:
     print(f"Tool discovery complete. Total tools found: {len(discovered_tools)}")
     return discovered_tools
 
+# --- KPI Snapshot ---
+async def refresh_kpi_snapshot() -> None:
+    """Reload the per-building KPI snapshot from db-tools into memory."""
+    global kpi_snapshot, kpi_ranking
+    if not kpi_snapshot_callable:
+        return
+    result = await kpi_snapshot_callable()
+    try:
+        buildings = json.loads(result)
+    except json.JSONDecodeError:
+        print(f"KPI snapshot refresh failed: {result}")
+        return
+    kpi_ranking = sorted(
+        buildings,
+        key=lambda b: (b.get('avg_efficiency') is None, -(b.get('avg_efficiency') or 0)),
+    )
+    kpi_snapshot = buildings
+    print(f"KPI snapshot refreshed: {len(buildings)} buildings.")
+
+async def kpi_snapshot_refresher() -> None:
+    """Background loop keeping the in-memory KPI snapshot current."""
+    while True:
+        try:
+            await refresh_kpi_snapshot()
+        except Exception as e:
+            print(f"KPI snapshot refresh error: {e}")
+        await asyncio.sleep(KPI_SNAPSHOT_REFRESH_SECONDS)
+
+def find_building_in_snapshot(building_name: str) -> dict | None:
+    """In-memory equivalent of the `name ILIKE '%...%'` building lookup."""
+    needle = building_name.lower()
+    compact_needle = needle.replace(' ', '')
+    for building in kpi_snapshot or []:
+        name = building.get('name', '').lower()
+        if needle in name or compact_needle in name.replace(' ', ''):
+            return building
+    return None
+
 # --- Application Lifespan ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -114,8 +288,10 @@ async def lifespan(app: FastAPI):
     print("Agent Service: Lifespan startup...")
     llm = GoogleGenAI(model="gemini-1.5-flash", api_key=os.getenv("GEMINI_API_KEY"))
     all_tools = await discover_tools()
+    refresher = asyncio.create_task(kpi_snapshot_refresher())
     print(f"Agent Service: Lifespan ready. Discovered {len(all_tools)} tools.")
     yield
+    refresher.cancel()
     print("Agent Service: Lifespan shutdown.")
 
 # --- FastAPI Application ---
@@ -181,6 +357,10 @@ async def extract_entities_for_ui(user_message: str, text_answer: str) -> Extrac
 # --- Helper Functions ---
 async def get_building_uuid(building_name: str, db_tool_callable) -> str | None:
     """Get UUID for a building name."""
+    if kpi_snapshot is not None:
+        building = find_building_in_snapshot(building_name)
+        return building['building_uuid'] if building else None
+
     sql_query = f"""
     SELECT uuid FROM buildings 
     WHERE name ILIKE '%{building_name}%' 
@@ -296,11 +476,15 @@ async def call_llm_with_tools(user_message: str, session_id: str) -> str:
                         else:
                             print(f"📊 RAG had no data, trying database...")
                             break
+            except DownstreamOverloaded:
+                raise
             except Exception as e:
                 print(f"RAG tool error: {e}")
         
         # Handle building count queries
         if any(phrase in user_message_lower for phrase in ["how many buildings", "building count", "total buildings"]):
+            if kpi_snapshot is not None:
+                return f"You have {len(kpi_snapshot)} buildings."
             if db_tool_callable:
                 result = await db_tool_callable(sql_query="SELECT COUNT(*) as count FROM buildings;")
                 try:
@@ -312,9 +496,15 @@ async def call_llm_with_tools(user_message: str, session_id: str) -> str:
         
         # Handle best performing building queries
         if any(phrase in user_message_lower for phrase in ["best performing", "top performing", "highest efficiency", "best building"]):
-            if db_tool_callable:
+            if db_tool_callable or kpi_snapshot is not None:
                 try:
-                    if "savings" in user_message_lower:
+                    if kpi_snapshot is not None:
+                        # Served from the in-memory snapshot; mirrors the two queries below.
+                        if "savings" in user_message_lower:
+                            data = [b for b in kpi_ranking if b.get('avg_efficiency') is not None][:3]
+                        else:
+                            data = kpi_ranking[:5]
+                    elif "savings" in user_message_lower:
                         # Query for building with best savings/efficiency
                         result = await db_tool_callable(sql_query="""
                             SELECT b.name, AVG(dm.efficiency) as avg_efficiency 
@@ -324,6 +514,7 @@ async def call_llm_with_tools(user_message: str, session_id: str) -> str:
                             ORDER BY avg_efficiency DESC 
                             LIMIT 3;
                         """)
+                        data = json.loads(result)
                     else:
                         # General best performing query
                         result = await db_tool_callable(sql_query="""
@@ -334,8 +525,8 @@ async def call_llm_with_tools(user_message: str, session_id: str) -> str:
                             ORDER BY avg_efficiency DESC 
                             LIMIT 5;
                         """)
+                        data = json.loads(result)
                     
-                    data = json.loads(result)
                     if data and len(data) > 0:
                         response = "Based on your building data, here are the top performers:\n\n"
                         for i, building in enumerate(data, 1):
@@ -346,6 +537,8 @@ async def call_llm_with_tools(user_message: str, session_id: str) -> str:
                             else:
                                 response += f"{i}. {name}: Performance data being collected\n"
                         return response
+                except DownstreamOverloaded:
+                    raise
                 except Exception as e:
                     print(f"Best performing query error: {e}")
         
@@ -372,13 +565,23 @@ async def call_llm_with_tools(user_message: str, session_id: str) -> str:
                         return f"Report generated successfully! {pdf_result}"
                         
                 return "Report generation initiated. Building performance data compiled."
+            except DownstreamOverloaded:
+                raise
             except Exception as e:
                 print(f"Report generation error: {e}")
                 return "Report generation is being prepared. Please check back shortly."
         
         # Handle building-specific queries
         entities = await extract_entities_for_ui(user_message, "")
-        if entities.building_name and entities.metric and db_tool_callable:
+        if entities.building_name and entities.metric in ("efficiency", "status") and kpi_snapshot is not None:
+            building = find_building_in_snapshot(entities.building_name)
+            if building and entities.metric == "efficiency":
+                if building.get('latest_efficiency') is not None:
+                    return f"The efficiency of {entities.building_name} is {building['latest_efficiency']:.2f}."
+                return f"The efficiency data for {entities.building_name} is currently being processed."
+            if building and entities.metric == "status":
+                return f"The status of {entities.building_name} is {building.get('asset_status')}."
+        elif entities.building_name and entities.metric and db_tool_callable:
             if entities.metric == "efficiency":
                 sql = f"""
                 SELECT efficiency FROM daily_metrics 
@@ -417,11 +620,15 @@ async def call_llm_with_tools(user_message: str, session_id: str) -> str:
         global llm
         if llm:
             # FIXED: Use the correct LlamaIndex API
-            response = await llm.achat([ChatMessage(role="user", content=user_message)])
+            response = await downstream_guards["gemini"].call(
+                lambda: llm.achat([ChatMessage(role="user", content=user_message)]), LLM_TIMEOUT_SECONDS
+            )
             return str(response.message.content)
         
         return "I can help you with building information. Ask me about building counts, efficiency, or status."
         
+    except DownstreamOverloaded:
+        raise
     except Exception as e:
         print(f"Error in smart tool calling: {e}")
         return "I'm here to help with building data. Try asking 'How many buildings do we have?' or about specific building efficiency."
@@ -435,6 +642,7 @@ async def chat(request: ChatRequest):
 
     user_message = request.message
     print(f"Received chat request: {user_message}")
+    deadline_token = request_deadline.set(time.monotonic() + CHAT_DEADLINE_SECONDS)
     
     try:
         # --- STEP 1: Get text response using smart tool calling ---
@@ -454,9 +662,18 @@ async def chat(request: ChatRequest):
         print(f"Final UI actions: {ui_actions}")
         return AgentResponse(text=text_response, ui_actions=ui_actions)
         
+    except DownstreamOverloaded as e:
+        print(f"Shedding chat request: {e}")
+        return JSONResponse(
+            status_code=503,
+            content=AgentResponse(text="Noda Copilot is busy right now. Please try again in a moment.", ui_actions=[]).model_dump(),
+            headers={"Retry-After": "5"},
+        )
     except Exception as e:
         print(f"An unexpected error occurred in the main chat function: {e}")
         return AgentResponse(
             text=f"I'm here to help with building information. Try asking 'How many buildings do we have?'", 
             ui_actions=[]
-        )
\ No newline at end of file
+        )
+    finally:
+        request_deadline.reset(deadline_token)
\ No newline at end of file
@@ -1,7 +1,9 @@
 # File: apps/rag-service/main.py
 
+import json
 import os
 import asyncpg
+import numpy as np
 from fastapi import FastAPI, Response
 from fastmcp.server import FastMCP
 from llama_index.core import Settings, PromptTemplate
@@ -24,6 +26,23 @@ if not api_key or not DATABASE_URL:
 Settings.embed_model = GoogleGenAIEmbedding(model_name="models/text-embedding-004")
 Settings.llm = GoogleGenAI(model_name="models/gemini-1.5-flash", api_key=api_key)
 print("RAG Service: Models initialized.")
+
+# --- Context Assembly Configuration ---
+# Candidates fetched from pgvector before deduplication and reranking.
+RAG_CANDIDATE_COUNT = int(os.getenv("RAG_CANDIDATE_COUNT", "12"))
+# Maximum (estimated) tokens of retrieved context placed into the prompt. The budget is
+# additionally capped at the size of the top-k baseline, so assembly can only trim.
+RAG_CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "1200"))
+# Maximum number of chunks placed into the prompt.
+RAG_MAX_CHUNKS = int(os.getenv("RAG_MAX_CHUNKS", "3"))
+# A chunk is only truncated into the leftover budget if at least this many tokens remain.
+RAG_MIN_FRAGMENT_TOKENS = 8
+# Chunks at least this similar to an already selected chunk are treated as duplicates.
+RAG_DEDUP_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0.95"))
+# MMR trade-off between relevance to the query (1.0) and diversity (0.0).
+RAG_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+# Number of chunks the previous fixed top-k retrieval used; the baseline for "tokens saved".
+BASELINE_TOP_K = 3
 # ---------------------------------------------
 
 # --- Application Setup ---
@@ -35,6 +54,64 @@ mcp_app = mcp.http_app()
 app = FastAPI(title="RAG Tools Host", lifespan=mcp_app.lifespan)
 
 
+# --- Context Assembly ---
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token) used for budgeting."""
+    return max(1, len(text) // 4)
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to at most max_tokens, preferring to end on a sentence or line boundary."""
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    # Leave room for the " ..." marker so the result stays within the budget.
+    cut = text[:max_chars - 4]
+    boundary = max(cut.rfind(". "), cut.rfind("\n"))
+    if boundary > max_chars // 2:
+        cut = cut[:boundary + 1]
+    return cut.rstrip() + " ..."
+
+def assemble_context(query_embedding: list[float], candidates: list[dict], token_budget: int) -> tuple[list[str], int]:
+    """
+    Select chunks for the prompt from the over-fetched candidates.
+
+    Near-duplicates are dropped, the rest are picked greedily by maximal marginal
+    relevance and added until RAG_MAX_CHUNKS or the token budget is reached; the
+    last chunk that does not fit whole is truncated. Returns the selected texts
+    and their token estimate.
+    """
+    vectors = np.array([c["embedding"] for c in candidates], dtype=float)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    query = np.array(query_embedding, dtype=float)
+    query /= np.linalg.norm(query) + 1e-12
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+
+    selected: list[int] = []
+    remaining = list(range(len(candidates)))
+    texts: list[str] = []
+    used_tokens = 0
+    while remaining and len(texts) < RAG_MAX_CHUNKS and used_tokens < token_budget:
+        def mmr_score(i: int) -> float:
+            redundancy = max((similarity[i, j] for j in selected), default=0.0)
+            return RAG_MMR_LAMBDA * relevance[i] - (1 - RAG_MMR_LAMBDA) * redundancy
+        best = max(remaining, key=mmr_score)
+        remaining.remove(best)
+        if selected and max(similarity[best, j] for j in selected) >= RAG_DEDUP_THRESHOLD:
+            continue
+        text = candidates[best]["content"]
+        tokens = estimate_tokens(text)
+        if used_tokens + tokens > token_budget:
+            if token_budget - used_tokens < RAG_MIN_FRAGMENT_TOKENS:
+                break
+            text = truncate_to_tokens(text, token_budget - used_tokens)
+            tokens = estimate_tokens(text)
+        selected.append(best)
+        texts.append(text)
+        used_tokens += tokens
+    return texts, used_tokens
+
+
 # --- Tool Definition ---
 @mcp.tool()
 async def query_documents(query: str) -> str:
@@ -67,16 +144,29 @@ async def query_documents(query: str) -> str:
 
         async with db_pool.acquire() as conn:
             sql_query = """
-                SELECT content FROM document_chunks
+                SELECT content, embedding::text AS embedding FROM document_chunks
+                WHERE embedding IS NOT NULL
                 ORDER BY embedding <=> $1
-                LIMIT 3;
+                LIMIT $2;
             """
-            retrieved_records = await conn.fetch(sql_query, str(query_embedding))
+            retrieved_records = await conn.fetch(sql_query, str(query_embedding), RAG_CANDIDATE_COUNT)
 
         if not retrieved_records:
             return "No relevant information found in the documents for your query."
 
-        context_str = "\n\n---\n\n".join([record['content'] for record in retrieved_records])
+        candidates = [
+            {"content": record['content'], "embedding": json.loads(record['embedding'])}
+            for record in retrieved_records
+        ]
+        baseline_tokens = sum(estimate_tokens(c["content"]) for c in candidates[:BASELINE_TOP_K])
+        token_budget = min(RAG_CONTEXT_TOKEN_BUDGET, baseline_tokens)
+        context_chunks, context_tokens = assemble_context(query_embedding, candidates, token_budget)
+        context_str = "\n\n---\n\n".join(context_chunks)
+
+        print(
+            f"RAG context: {len(context_chunks)}/{len(candidates)} chunks, ~{context_tokens} tokens "
+            f"(top-{BASELINE_TOP_K} baseline ~{baseline_tokens}, saved ~{baseline_tokens - context_tokens})"
+        )
 
         qa_prompt_tmpl = (
             "You are an expert assistant. Your task is to answer the user's query based ONLY on the context provided below.\n"